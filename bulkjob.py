@@ -0,0 +1,93 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BulkJob(object):
+    """ a Bulk API job that takes many batches at once and hands back their results as they complete """
+    conn = None
+    sfdc_object = None
+    operation = None
+    external_id = None
+    concurrency_mode = 'Parallel'
+    # seconds between two checks of the batch states
+    poll_interval = 2
+    # number of batch results downloaded at once
+    max_workers = 4
+    job_id = None
+    pending = None
+
+    def __init__(self, conn, sfdc_object, operation, external_id=None, concurrency_mode='Parallel', poll_interval=2,
+                 max_workers=4):
+        self.conn = conn
+        self.sfdc_object = sfdc_object
+        self.operation = operation
+        self.external_id = external_id
+        self.concurrency_mode = concurrency_mode
+        self.poll_interval = poll_interval
+        self.max_workers = max(1, max_workers)
+        self.pending = {}
+
+    def request(self, method, path, data=None):
+        response = self.conn.session.request(method, self.conn.bulk_url + path,
+                                             headers={"X-SFDC-Session": self.conn.session_id,
+                                                      "Content-Type": "application/json; charset=UTF-8"},
+                                             data=json.dumps(data, default=dict) if data is not None else None)
+        response.raise_for_status()
+        return response.json()
+
+    def open(self):
+        job = {"operation": self.operation, "object": self.sfdc_object, "contentType": "JSON",
+               "concurrencyMode": self.concurrency_mode}
+        if self.operation == 'upsert':
+            job["externalIdFieldName"] = self.external_id
+        self.job_id = self.request('POST', 'job', job)["id"]
+        return self.job_id
+
+    def submit(self, records):
+        batch_id = self.request('POST', 'job/%s/batch' % self.job_id, records)["id"]
+        self.pending[batch_id] = records
+        return batch_id
+
+    def close(self):
+        self.request('POST', 'job/%s' % self.job_id, {"state": "Closed"})
+
+    def abort(self):
+        """ stop the job, Salesforce does not process the batches it has not started yet """
+        self.request('POST', 'job/%s' % self.job_id, {"state": "Aborted"})
+
+    def poll(self):
+        """ returns the (record, result) pairs of the batches that finished since the last poll """
+        if not self.pending:
+            return []
+        # one call returns the state of every batch of the job
+        batches = self.request('GET', 'job/%s/batch' % self.job_id)["batchInfo"]
+        finished = [batch for batch in batches if batch["id"] in self.pending
+                    and batch["state"] in ('Completed', 'Failed', 'Not Processed')]
+        if not finished:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(finished), self.max_workers)) as executor:
+            results = list(executor.map(self.get_results, finished))
+        pairs = []
+        for batch, result in zip(finished, results):
+            records = self.pending.pop(batch["id"])
+            # a batch that failed as a whole has no per record results
+            if len(result) != len(records):
+                result = [''] * len(records)
+            pairs.extend(zip(records, result))
+        return pairs
+
+    def get_results(self, batch):
+        try:
+            return self.request('GET', 'job/%s/batch/%s/result' % (self.job_id, batch["id"]))
+        except Exception:
+            return []
+
+    def wait(self):
+        """ yields the (record, result) pairs of the remaining batches as they finish """
+        while self.pending:
+            pairs = self.poll()
+            if pairs:
+                yield pairs
+            else:
+                time.sleep(self.poll_interval)
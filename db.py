@@ -1,7 +1,98 @@
 import sqlite3
 import threading
+import queue
 from sqlite3 import Error
 import json
+import zlib
+import datetime
+import hashlib
+from collections.abc import Mapping
+
+# prefix of the values stored compressed, anything else in the database is stored as is
+compressed_marker = b'zlib:'
+
+
+def compress_value(value):
+    return compressed_marker + zlib.compress(value.encode('utf-8'), 1)
+
+
+def decompress_value(value):
+    if isinstance(value, bytes) and value.startswith(compressed_marker):
+        return zlib.decompress(value[len(compressed_marker):]).decode('utf-8')
+    return value
+
+
+def record_hash(record, skip_fields=()):
+    """ a stable hash of a record as it is sent to Salesforce """
+    payload = {field: value for field, value in record.items() if field not in skip_fields}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Record(object):
+    """ a read-only row that keeps its values in a tuple and shares the column names with the other rows of the
+    same query, it can be used like a dict """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, field):
+        return self._values[self._columns[field]]
+
+    def get(self, field, default=None):
+        index = self._columns.get(field)
+        return default if index is None else self._values[index]
+
+    def __contains__(self, field):
+        return field in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._columns.keys()
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._columns, self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getstate__(self):
+        return self._columns, self._values
+
+    def __setstate__(self, state):
+        self._columns, self._values = state
+
+
+Mapping.register(Record)
+
+
+def record_factory():
+    """ a row factory building Records, the column names are only looked up once per query """
+    query = {"description": None, "columns": None}
+
+    def to_record(cursor, row):
+        if cursor.description is not query["description"]:
+            query["description"] = cursor.description
+            query["columns"] = {col[0]: index for index, col in enumerate(cursor.description)}
+        if any(type(value) is bytes for value in row):
+            row = tuple(decompress_value(value) for value in row)
+        return Record(query["columns"], row)
+
+    return to_record
 
 
 def format_value(value, field_type):
@@ -14,28 +105,154 @@ def format_value(value, field_type):
 class Db:
     db_path = "./"
     conn = None
-    db = None
     schema = None
     logger = None
     custom_field_prefix = 'custom_'
-    lock = threading.Lock()
+    # fields added to every table to keep track of the migration: the new Salesforce Id and the hash of the record
+    # as it was last uploaded successfully
+    tracking_fields = ['newId', 'newHash']
+    # records rejected by Salesforce, kept until a retry succeeds
+    failures_table = 'failures'
+    # source org Ids and the Ids of the same records in the destination org
+    id_map_table = 'id_map'
+    # all writes go through a single writer thread, which commits up to this many queued writes in one transaction
+    group_commit_size = 100
+    writes = None
+    writer = None
+    readers = None
+    # text values of at least this many characters are compressed, None disables compression
+    compress_threshold = None
+    # only long and rich text area fields are worth compressing
+    compressed_field_types = ['textarea']
+    compressed_field_min_length = 256
 
-    def __init__(self, db_path, logger):
+    def __init__(self, db_path, logger, compress_threshold=None):
         self.db_path = db_path
         self.logger = logger
+        self.compress_threshold = compress_threshold
+        self.readers = threading.local()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=60)
+        conn.isolation_level = None
+        # self.conn.row_factory = sqlite3.Row Records are smaller than dicts and behave like them
+        conn.row_factory = record_factory()
+        return conn
 
     def create_connection(self, schema):
         """ create a database connection to a SQLite database """
         try:
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.conn.isolation_level = None
-            # self.conn.row_factory = sqlite3.Row The algorithm below is better at transforming each row into a dict
-            self.conn.row_factory = lambda c, r: dict(zip([col[0] for col in c.description], r))
-            self.db = self.conn.cursor()
+            self.conn = self.connect()
+            # readers do not block the writer, and see what it committed
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.readers.conn = self.conn
+            self.readers.db = self.conn.cursor()
             self.schema = schema
+            self.start_writer()
+            self.create_failures_table()
+            self.create_id_map_table()
         except Error as e:
             self.logger.error('Error creating local database connection: %s', e)
 
+    @property
+    def db(self):
+        """ the cursor of the calling thread, each thread reads through its own connection """
+        if getattr(self.readers, 'db', None) is None:
+            self.readers.conn = self.connect()
+            self.readers.db = self.readers.conn.cursor()
+        return self.readers.db
+
+    def query(self, sql, params=()):
+        self.db.execute(sql, params)
+        return self.db.fetchall()
+
+    def start_writer(self):
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.run_writer, name='db-writer', daemon=True)
+        self.writer.start()
+
+    def run_writer(self):
+        conn = self.connect()
+        db = conn.cursor()
+        while True:
+            jobs = [self.writes.get()]
+            # group commit: the writes queued while the previous transaction ran all go into this one
+            while len(jobs) < self.group_commit_size:
+                try:
+                    jobs.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in jobs
+            jobs = [job for job in jobs if job is not None]
+            try:
+                self.write_jobs(conn, db, jobs)
+            except Exception as e:
+                # nothing of this transaction was committed, the writer carries on with the next one
+                self.logger.error('Error committing database writes: %s', e)
+                try:
+                    if conn.in_transaction:
+                        db.execute("rollback")
+                except Error:
+                    pass
+                for job in jobs:
+                    job["result"] = None
+                    if job["error"] is None:
+                        job["error"] = e
+            finally:
+                for job in jobs:
+                    job["done"].set()
+            if stop:
+                conn.close()
+                return
+
+    @staticmethod
+    def write_jobs(conn, db, jobs):
+        db.execute("begin")
+        for job in jobs:
+            # a failing write only rolls back its own changes
+            db.execute("savepoint job")
+            try:
+                job["result"] = job["write"](db)
+                db.execute("release job")
+            except Exception as e:
+                job["error"] = e
+                if not conn.in_transaction:
+                    # errors such as a full disk abort the whole transaction, savepoints included
+                    raise
+                db.execute("rollback to job")
+                db.execute("release job")
+        db.execute("commit")
+
+    def write(self, table_name, write):
+        """ run write(cursor) on the writer thread and wait until its transaction is committed """
+        job = {"write": write, "done": threading.Event(), "result": None, "error": None}
+        writer = self.writer
+        if writer is None or not writer.is_alive():
+            raise Error('The database writer is not running, can not write to table %s' % table_name)
+        self.writes.put(job)
+        while not job["done"].wait(1):
+            if not writer.is_alive():
+                raise Error('The database writer stopped, can not write to table %s' % table_name)
+        if job["error"] is not None:
+            self.logger.error('Error writing to database table %s: %s', table_name, job["error"])
+        return job["result"]
+
+    def close(self):
+        if self.writer is not None:
+            self.writes.put(None)
+            self.writer.join()
+            self.writer = None
+        self.conn.close()
+
+    def create_failures_table(self):
+        sql = '''CREATE TABLE IF NOT EXISTS %s(object TEXT, Id TEXT, statusCode TEXT, message TEXT, fields TEXT,
+                 failedAt TEXT, PRIMARY KEY (object, Id))''' % self.failures_table
+        self.write(self.failures_table, lambda db: db.execute(sql))
+
+    def create_id_map_table(self):
+        sql = 'CREATE TABLE IF NOT EXISTS %s(Id TEXT PRIMARY KEY, newId TEXT, object TEXT)' % self.id_map_table
+        self.write(self.id_map_table, lambda db: db.execute(sql))
+
     def create_tables(self):
         try:
             for table_name in self.schema:
@@ -45,29 +262,46 @@ class Db:
             self.logger.error('Error creating database tables: %s', e)
 
     def delete_tables(self):
-        try:
+        def write(db):
             for table_name in self.schema:
                 sql = """ DROP TABLE IF EXISTS %s """ % table_name
-                self.db.execute(sql)
-        except Error as e:
-            self.logger.error('Error deleting database tables: %s', e)
+                db.execute(sql)
+            db.execute(""" DELETE FROM %s """ % self.failures_table)
+
+        self.write('all tables', write)
+
+    def get_compressed_fields(self, table_name):
+        if self.compress_threshold is None:
+            return []
+        compressed_fields = []
+        for field, field_schema in self.schema[table_name]["fields"].items():
+            if field_schema.get('type') in self.compressed_field_types \
+                    and (field_schema.get('length') or 0) >= self.compressed_field_min_length:
+                compressed_fields.append(field)
+        return compressed_fields
 
     def insert_records(self, table_name, records):
-        self.db.execute("begin")
+        self.write(table_name, lambda db: self.write_records(db, table_name, records))
+
+    def write_records(self, db, table_name, records):
+        compressed_fields = self.get_compressed_fields(table_name)
         for record in records:
             values = ()
             sql = "INSERT INTO " + table_name + "("
             for field in self.schema[table_name]["fields"]:
-                if field == 'VersionData' or field == 'Body' or field == 'newId':
+                if field == 'VersionData' or field == 'Body' or field in self.tracking_fields:
                     continue
                     # record[field] = None
-                values += (record[field],)
+                value = record[field]
+                if field in compressed_fields and isinstance(value, str) and len(value) >= self.compress_threshold:
+                    value = compress_value(value)
+                values += (value,)
                 sql += field + ","
             sql = sql[:-1]
             sql += ")"
             sql += " values ("
             for field in self.schema[table_name]["fields"]:
-                if field == 'VersionData' or field == 'Body' or field == 'newId':
+                if field == 'VersionData' or field == 'Body' or field in self.tracking_fields:
                     continue
                 sql += "?,"
             sql = sql[:-1]
@@ -75,7 +309,7 @@ class Db:
 
             sql += " ON CONFLICT (Id) DO UPDATE SET "
             for field in self.schema[table_name]["fields"]:
-                if field == 'VersionData' or field == 'Body' or field == 'newId':
+                if field == 'VersionData' or field == 'Body' or field in self.tracking_fields:
                     continue
                 sql += field + "=?,"
             sql = sql[:-1]
@@ -84,14 +318,9 @@ class Db:
             values += values
             # print(values)
             try:
-                self.db.execute(sql, values)
+                db.execute(sql, values)
             except Error as e:
                 self.logger.error('Error inserting database records in table %s: %s', table_name, e)
-        try:
-            self.db.execute("commit")
-        except Error as e:
-            self.logger.error('Error inserting database records in table %s: %s', table_name, e)
-            self.db.execute("rollback")
 
 
 
@@ -117,27 +346,152 @@ class Db:
             self.db.execute("rollback")
 
     def update_external_ids(self, table_name, records, external_id):
-        try:
-            self.lock.acquire(True)
-            self.db.execute("begin")
+        """ store the destination org Ids of the records Salesforce accepted, the uploaded records carry their source
+        org Id in the external id field """
+        def write(db):
+            key = external_id
             for record in records:
+                if not record[1] or not record[1]["success"]:
+                    continue
                 sql = 'UPDATE %s SET newId = ? WHERE Id = ?' % table_name
                 if table_name == 'articles':
-                    external_id = "urlName"
+                    key = "urlName"
                 # print("UPDATE %s SET external_id = %s WHERE id = %s" % (table_name, record[1]["id"], record[0][external_id]))
-                self.db.execute(sql, (record[1]["id"], record[0][external_id]))
-            try:
-                self.db.execute("commit")
-            except Error as e:
-                self.logger.error('Error inserting database records in table %s: %s', table_name, e)
-                self.db.execute("rollback")
-        finally:
-            self.lock.release()
+                db.execute(sql, (record[1]["id"], record[0][key]))
+
+        self.write(table_name, write)
+
+    def get_payload(self, record, external_id):
+        """ the record as it is sent to Salesforce: without its source org Id and the tracking fields, and with the
+        source org Id in the external id field the upsert matches on """
+        payload = {field: value for field, value in record.items()
+                   if field != 'Id' and field not in self.tracking_fields}
+        payload[external_id] = record['Id']
+        return payload
+
+    def get_changed_payloads(self, records, external_id):
+        """ the records to send, leaving out the ones unchanged since their last successful upload, returns the
+        payloads and the number of records left out """
+        payloads = []
+        for record in records:
+            payload = self.get_payload(record, external_id)
+            if record.get('newId') is None or record.get('newHash') != record_hash(payload):
+                payloads.append(payload)
+        return payloads, len(records) - len(payloads)
+
+    def update_hashes(self, table_name, records, external_id):
+        """ remember what was sent for the records Salesforce accepted, the payloads carry the source org Id in
+        their external id field, like for update_external_ids """
+        def write(db):
+            for record in records:
+                if record[1] and record[1]["success"]:
+                    db.execute('UPDATE %s SET newHash = ? WHERE Id = ?' % table_name,
+                               (record_hash(record[0]), record[0][external_id]))
+
+        self.write(table_name, write)
+
+    def refresh_id_map(self):
+        """ copy the new Ids of every staged table into the id map """
+        def write(db):
+            for table_name in self.schema:
+                try:
+                    db.execute("INSERT OR REPLACE INTO %s (Id, newId, object) SELECT Id, newId, '%s' FROM %s "
+                               "WHERE newId IS NOT NULL" % (self.id_map_table, table_name, table_name))
+                except Error as e:
+                    self.logger.warning('Could not read new Ids from table %s: %s', table_name, e)
+
+        self.write(self.id_map_table, write)
+
+    def insert_id_map(self, table_name, ids):
+        """ add (source Id, destination Id) pairs of records that were not uploaded from this database """
+        self.write(self.id_map_table, lambda db: db.executemany("INSERT OR REPLACE INTO %s (Id, newId, object) "
+                                                                "VALUES (?, ?, '%s')" % (self.id_map_table, table_name),
+                                                                ids))
+
+    def get_relinked_fields(self, table_name, mapped_objects):
+        """ the lookups of the table to mapped_objects, with the objects each of them references """
+        fields = {}
+        for field, field_schema in self.schema[table_name]["fields"].items():
+            reference_to = field_schema.get('referenceTo') or []
+            if field_schema.get('type') == 'reference' and set(reference_to) & set(mapped_objects):
+                fields[field] = reference_to
+        return fields
+
+    def create_relinked_view(self, table_name, mapped_objects, defaults):
+        """ create a view of the table with its lookups pointing to the destination org Ids
+
+        Only lookups to mapped_objects are relinked, lookups that can not be resolved fall back to the default Id
+        configured for the referenced object, or are left as they are for Salesforce to reject.
+        """
+        view_name = table_name + '_relinked'
+        relinked_fields = self.get_relinked_fields(table_name, mapped_objects)
+        columns = []
+        joins = []
+        for field in self.schema[table_name]["fields"]:
+            if field not in relinked_fields:
+                columns.append('T.%s' % field)
+                continue
+            default = 'T.%s' % field
+            for sfdc_object in relinked_fields[field]:
+                if sfdc_object in defaults:
+                    default = "'%s'" % defaults[sfdc_object]
+                    break
+            alias = 'M%s' % len(joins)
+            joins.append('LEFT JOIN %s %s ON %s.Id = T.%s' % (self.id_map_table, alias, alias, field))
+            columns.append("CASE WHEN T.%s IS NULL OR T.%s = '' THEN T.%s ELSE COALESCE(%s.newId, %s) END %s"
+                           % (field, field, field, alias, default, field))
+        def write(db):
+            db.execute('DROP VIEW IF EXISTS %s' % view_name)
+            db.execute('CREATE VIEW %s AS SELECT %s FROM %s T %s'
+                       % (view_name, ', '.join(columns), table_name, ' '.join(joins)))
+            return view_name
+
+        return self.write(view_name, write)
+
+    def get_unresolved_lookups(self, table_name, mapped_objects):
+        """ the number of records of the table whose lookup can not be relinked, per lookup field """
+        unresolved = {}
+        for field in self.get_relinked_fields(table_name, mapped_objects):
+            res = self.db.execute("SELECT count(T.Id) total FROM %s T LEFT JOIN %s M ON M.Id = T.%s "
+                                  "WHERE T.%s IS NOT NULL AND T.%s <> '' AND M.Id IS NULL"
+                                  % (table_name, self.id_map_table, field, field, field))
+            total = res.fetchone()['total']
+            if total:
+                unresolved[field] = total
+        return unresolved
+
+    def record_results(self, table_name, records, key):
+        """ keep track of the records Salesforce rejected, and forget the ones that made it in """
+        failed_at = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        def write(db):
+            for record in records:
+                if record[1] and record[1]["success"]:
+                    db.execute('DELETE FROM %s WHERE object = ? AND Id = ?' % self.failures_table,
+                               (table_name, record[0][key]))
+                    continue
+                errors = record[1]["errors"] if record[1] and record[1]["errors"] else \
+                    [{"statusCode": None, "message": 'No result returned by Salesforce', "fields": []}]
+                db.execute('INSERT OR REPLACE INTO %s (object, Id, statusCode, message, fields, failedAt) '
+                           'VALUES (?, ?, ?, ?, ?, ?)' % self.failures_table,
+                           (table_name, record[0][key], errors[0].get("statusCode"), errors[0].get("message"),
+                            json.dumps(errors[0].get("fields")), failed_at))
+
+        self.write(self.failures_table, write)
+
+    def get_failed_records_clause(self, table_name, id_column='Id'):
+        # where clause selecting the staged records of a table that were rejected on their last upload
+        return " %s IN (SELECT Id FROM %s WHERE object = '%s') " % (id_column, self.failures_table, table_name)
+
+    def get_failure_count(self, table_name):
+        res = self.db.execute("SELECT count(Id) total FROM %s WHERE object = ?" % self.failures_table, (table_name,))
+        return res.fetchone()['total']
 
     def create_table(self, table_name):
         fields_sql = ""
-        # add an additional field to store teh new Salesforce Id after import
-        self.schema[table_name]["fields"]["newId"] = {}
+        # add additional fields to store teh new Salesforce Id and the hash of the record after import
+        for field in self.tracking_fields:
+            self.schema[table_name]["fields"][field] = {}
         table_schema = self.schema[table_name]["fields"]
         # print(table_schema)
         for field in table_schema.keys():
@@ -150,21 +504,55 @@ class Db:
         sql += fields_sql
         sql += ''')'''
         # print(sql)
-        try:
-            self.db.execute(sql)
-        except Error as e:
-            self.logger.error('Error creating database table  %s: %s', table_name, e)
+
+        def write(db):
+            db.execute(sql)
+            # tables staged by an earlier version may miss some of the tracking fields
+            columns = [column['name'] for column in db.execute('PRAGMA table_info(%s)' % table_name).fetchall()]
+            for field in self.tracking_fields:
+                if field not in columns:
+                    db.execute('ALTER TABLE %s ADD COLUMN %s TEXT' % (table_name, field))
+
+        self.write(table_name, write)
+
+    def get_fields(self, table_name):
+        # the staged fields, without the ones added to keep track of the migration
+        return [field for field in self.schema[table_name]["fields"] if field not in self.tracking_fields]
 
     def get_records(self, table_name, where_clause=None, limit=None, offset=None):
+        sql = "SELECT * FROM %s" % table_name
         if where_clause is not None:
-            where_clause = 'WHERE %s' % where_clause
-        sql = "SELECT * FROM %s %s ORDER BY id;" % (table_name, where_clause)
+            sql += ' WHERE %s' % where_clause
+        sql += ' ORDER BY id'
         if limit is not None and offset is not None:
-            sql = "SELECT * FROM %s ORDER BY id LIMIT %s, %s;" % (table_name, offset, limit)
+            sql += ' LIMIT %s, %s' % (offset, limit)
         self.db.execute(sql)
         rows = self.db.fetchall()
         return rows
 
+    def get_field_sum(self, table_name, field, where_clause=None):
+        sql = "SELECT count(id) total, sum(CAST(%s AS INTEGER)) size FROM %s" % (field, table_name)
+        if where_clause is not None:
+            sql += ' WHERE %s' % where_clause
+        try:
+            values = self.db.execute(sql).fetchone()
+        except Error as e:
+            self.logger.warning('Could not read %s from table %s: %s', field, table_name, e)
+            return None
+        return values['total'], values['size'] or 0
+
+    def get_average_record_size(self, table_name, sample_size=1000):
+        # estimate the size of a record as sent over the wire from a sample of the staged rows
+        try:
+            self.db.execute("SELECT * FROM %s LIMIT %s;" % (table_name, sample_size))
+            rows = self.db.fetchall()
+        except Error as e:
+            self.logger.warning('Could not sample table %s: %s', table_name, e)
+            return None
+        if not rows:
+            return None
+        return int(sum(len(json.dumps(row, default=dict)) for row in rows) / len(rows))
+
     def get_record_count(self, table_name):
         sql = "SELECT count(id) FROM %s ;" % (table_name)
         res = self.db.execute(sql)
@@ -9,8 +9,13 @@ import time
 import datetime
 import logging
 import argparse
+import functools
+import tempfile
 from math import ceil
 import transformations
+import planner
+import profiler
+import scheduler
 
 
 def group_records(records, group_count):
@@ -26,10 +31,18 @@ def group_records(records, group_count):
     return grouped
 
 
+def is_large_file(rec):
+    return int(rec["ContentSize"] or 0) > sfSource.large_file_size
+
+
 def fetch_contentversions(sf, rec):
+    if is_large_file(rec):
+        # the body is streamed when the file is uploaded
+        return sf.create_content_metadata(rec, config["externalIds"]["ContentVersion"])
     body_url = '/services/data/v42.0/sobjects/ContentVersion/%s/VersionData' % rec["Id"]
     print(body_url)
-    body = sf.get_filebody(body_url)
+    with source_scheduler.slot():
+        body = sf.get_filebody(body_url)
     if body is None:
         return None
     return sf.create_content(rec, body, config["externalIds"]["ContentVersion"])
@@ -37,20 +50,123 @@ def fetch_contentversions(sf, rec):
 
 def upload_contentversions(sf, attachments, use_bulk=True):
     res = sf.upload_contentversions(attachments, use_bulk)
+    store_contentversion_results(attachments, res)
+
+
+def upload_large_contentversion(source, destination, attachment):
+    # pass the body through a temporary file rather than holding it, base64 encoded, in memory
+    body_url = '/services/data/v42.0/sobjects/ContentVersion/%s/VersionData' \
+               % attachment[config["externalIds"]["ContentVersion"]]
+    res = None
+    with tempfile.TemporaryFile(dir=config["tempFilePath"]) as body:
+        with source_scheduler.slot():
+            downloaded = source.download_filebody(body_url, body)
+        if downloaded:
+            body.seek(0)
+            res = destination.upload_contentversion_stream(attachment, body)
+    store_contentversion_results([attachment], res)
+
+
+def store_contentversion_results(attachments, res):
     if res is not None:
         db.update_external_ids("ContentVersion", res, config["externalIds"]["ContentVersion"])
+    else:
+        res = [(attachment, '') for attachment in attachments]
+    db.record_results("ContentVersion", res, config["externalIds"]["ContentVersion"])
+
+
+def skipped_result(message, fields=None):
+    # the result recorded for a record that could not be sent, so that --retry-failed picks it up again
+    return {"success": False, "id": None, "errors": [{"statusCode": None, "message": message,
+                                                      "fields": fields or []}]}
+
+
+def store_contentdocumentlink_results(link_ids, res):
+    # links are inserted rather than upserted, so their results are matched to the staged links by position
+    results = []
+    for link_id, (link, result) in zip(link_ids, res):
+        if result and not result["success"] and result["errors"] \
+                and "already linked" in result["errors"][0]["message"]:
+            result = {"success": True, "id": None, "errors": []}
+        results.append(({"Id": link_id}, result))
+    db.record_results('ContentDocumentLink', results, 'Id')
 
 
 def fetch_attachments(sf, rec):
+    # runs in a child process, whose copy of the client is the one that sees the API usage of the call
     body_url = '/services/data/v42.0/sobjects/Attachment/%s/Body' % rec["Id"]
     body = sf.get_filebody(body_url)
-    return sf.create_attachment(rec, body)
+    return sf.create_attachment(rec, body), sf.api_usage
 
 
 def upload_attachments(sf, attachments):
     res = sf.upload_attachments(attachments)
     if res is not None:
         db.update_external_ids("Attachment", res, config["externalIds"]["Attachment"])
+    else:
+        res = [(attachment, '') for attachment in attachments]
+    db.record_results("Attachment", res, config["externalIds"]["Attachment"])
+
+
+# uploads still running in the background, their results are written to the database when they finish
+background_uploads = []
+
+
+def upload_in_background(upload, params):
+    # wait for the destination org to allow another upload, the slot is given back once the upload is done
+    destination_scheduler.acquire()
+
+    def run():
+        try:
+            upload(*params)
+        finally:
+            destination_scheduler.release()
+
+    background_uploads[:] = [thread for thread in background_uploads if thread.is_alive()]
+    thread = threading.Timer(1.0, run)
+    background_uploads.append(thread)
+    thread.start()
+
+
+def read_batches(table_name, batch_size, records=None):
+    # slices of the given records, or pages of the staged records when there are none
+    if records is not None:
+        for start in range(0, len(records), batch_size):
+            yield records[start:start + batch_size]
+        return
+    last_id = ''
+    while True:
+        # page on the primary key, an offset would re-read every earlier page through the view
+        batch = db.get_records(table_name, where_clause=" Id > '%s' " % last_id, limit=batch_size, offset=0)
+        if not batch:
+            return
+        last_id = batch[-1]['Id']
+        yield batch
+
+
+def to_payloads(batches, external_id):
+    # upserts match on the external id, which holds the source org Id
+    for batch in batches:
+        yield [db.get_payload(record, external_id) for record in batch]
+
+
+def select_changed(batches, external_id, counts, progress_bar):
+    # only send the records that were never uploaded or changed since their last successful upload
+    for batch in batches:
+        payloads, skipped = db.get_changed_payloads(batch, external_id)
+        counts["skipped"] += skipped
+        counts["sent"] += len(payloads)
+        bar_next(progress_bar, skipped)
+        if payloads:
+            yield payloads
+
+
+def store_upload_results(sfdc_object, res, progress_bar):
+    # now update the external id with the Salesforce Id
+    db.update_external_ids(sfdc_object, res, config["externalIds"][sfdc_object])
+    db.update_hashes(sfdc_object, res, config["externalIds"][sfdc_object])
+    db.record_results(sfdc_object, res, config["externalIds"][sfdc_object])
+    bar_next(progress_bar, len(res))
 
 
 def bar_next(progress_bar, increment):
@@ -68,6 +184,12 @@ app_description = """This program migrates data from one Salesforce source to a
                      python3 migrate.py --compare 
                      to compares the records (entities) in the source and destination orgs and print out the results in
                       the log file.
+                     or
+                     python3 migrate.py --plan
+                     to estimate the API calls, bytes and duration of each phase before running it.
+                     or
+                     python3 migrate.py --retry-failed
+                     to upload again only the records Salesforce rejected during a previous upload.
                      """
 parser = argparse.ArgumentParser(description=app_description)
 parser.add_argument('--download', action='store_true',
@@ -79,9 +201,18 @@ parser.add_argument('--upload', action='store_true',
 parser.add_argument('--compare', action='store_true',
                     help='Compares the records (entities) in the source and destination orgs and prints out the results'
                          ' in the log file')
+parser.add_argument('--plan', action='store_true',
+                    help='Estimates the Bulk API batches, REST calls, bytes and duration of each phase of a run and'
+                         ' flags the phases that would exceed the org limits or the maintenance window')
+parser.add_argument('--profile', action='store_true',
+                    help='Profiles each phase of the run and tracks its peak memory, writes a profile per phase next to'
+                         ' the log file and prints the hotspots at the end of the run')
+parser.add_argument('--retry-failed', action='store_true',
+                    help='Uploads again, in small batches, only the records that were rejected during a previous upload')
 args = parser.parse_args()
 
-if args.upload is False and args.download is False and args.compare is False:
+if args.upload is False and args.download is False and args.compare is False and args.plan is False \
+        and args.retry_failed is False:
     print(app_description)
     exit()
 
@@ -95,8 +226,9 @@ logFileName = now.strftime(time_pattern) + '.log'
 logging.basicConfig(filename=config["logFilePath"] + logFileName, filemode='w',
                     format='%(asctime)s | %(levelname)s | %(message)s', level=logging.INFO)
 logger = logging.getLogger('migration')
+profiler = profiler.Profiler(args.profile, config["logFilePath"], now.strftime(time_pattern), logger)
 
-db = db.Db('./db/sfdc.db', logger)
+db = db.Db('./db/sfdc.db', logger, config["compressTextThreshold"])
 
 sfdc_upload_batch_size = 10000
 sfdc_domain = None
@@ -111,7 +243,20 @@ sfDestination = sfdc.SFDCClient(config["salesforceLoginDestination"], config["sa
                                 "test" if config["salesforceIsSandboxDestination"] else None, logger)
 if sfSource.conn is None or sfDestination.conn is None:
     exit()
+source_scheduler = scheduler.ApiScheduler(sfSource, config["apiReserve"], 1, config["maxThreads"], config["threads"],
+                                          logger)
+destination_scheduler = scheduler.ApiScheduler(sfDestination, config["apiReserve"], 1, config["maxThreads"],
+                                               config["threads"], logger)
 schema = sfSource.get_schema(config["entities"])
+if config["projectToDestination"]:
+    skipped_fields = sfSource.project_schema(schema, sfDestination, config["namespaces"],
+                                             config["projectionRequiredFields"])
+    for sfdc_object, fields in skipped_fields.items():
+        if fields:
+            logger.info('Skipping %s fields of %s the destination can not accept: %s', len(fields), sfdc_object,
+                        ', '.join(fields))
+    print('Skipping %s fields the destination can not accept, see the log for details'
+          % sum(len(fields) for fields in skipped_fields.values()))
 db.create_connection(schema)
 
 if args.compare:
@@ -121,16 +266,7 @@ if args.compare:
     for sfdc_object in config["entities"]:
         total_records = 0
         bar = Bar(sfdc_object, max=1)
-        where_clause = None
-        if sfdc_object == 'ContentVersion':
-            where_clause = " isLatest = true  AND FileExtension != 'snote'"
-
-        if config["queryFilter"] is not None:
-            if where_clause is not None:
-                where_clause += " AND "
-            else:
-                where_clause = ""
-            where_clause += config["queryFilter"]
+        where_clause = sfdc.SFDCClient.get_download_where_clause(sfdc_object, config["queryFilter"])
 
         source_records = sfSource.get_records(sfdc_object, config["recordLimit"], where_clause=where_clause,
                                               field_list=['Id'])
@@ -141,6 +277,19 @@ if args.compare:
         bar.finish()
         # logger.info('Downloaded %s %s from Source', len(records), sfdc_object)
 
+if args.plan:
+    print('Planning migration')
+    plan = planner.build_plan(config, sfSource, db, schema, sfdc_upload_batch_size)
+    planner.check_limits(plan, 'source', sfSource.get_limits())
+    planner.check_limits(plan, 'destination', sfDestination.get_limits())
+    if config["maintenanceWindowMinutes"] is not None:
+        planner.check_window(plan, config["maintenanceWindowMinutes"] * 60)
+    print(planner.format_plan(plan))
+    logger.info('Migration plan:\n%s', planner.format_plan(plan))
+    for phase in plan:
+        for flag in phase["flags"]:
+            logger.warning('%s %s', phase["name"], flag)
+
 if args.download:
 
     if config["clearDatabase"]:
@@ -155,53 +304,102 @@ if args.download:
     logger.info('Downloading Salesforce.com data for %s', config["entities"])
 
     for sfdc_object in config["entities"]:
+        profiler.start('Download %s' % sfdc_object)
 
         total_records = 0
         bar = Bar(sfdc_object, max=1)
-        where_clause = None
-        if sfdc_object == 'ContentVersion':
-            where_clause = " isLatest = true  AND FileExtension != 'snote'"
+        where_clause = sfdc.SFDCClient.get_download_where_clause(sfdc_object, config["queryFilter"])
 
-        if config["queryFilter"] is not None:
-            if where_clause is not None:
-                where_clause += " AND "
-            else:
-                where_clause = ""
-            where_clause += config["queryFilter"]
-
-        records = sfSource.get_records(sfdc_object, config["recordLimit"], where_clause=where_clause)
+        field_list = db.get_fields(sfdc_object) if config["projectToDestination"] else None
+        records = sfSource.get_records(sfdc_object, config["recordLimit"], where_clause=where_clause,
+                                       field_list=field_list)
         db.insert_records(sfdc_object, records)
 
         bar.next()
         bar.finish()
         logger.info('Downloaded %s %s', len(records), sfdc_object)
+        profiler.stop()
+
+if args.upload or args.retry_failed:
 
-if args.upload:
+    relink_defaults = dict(config["relinkDefaults"])
+    relink_defaults.setdefault("User", config["defaultUserId"])
+    if config["relinkLookups"]:
+        # records that are matched rather than uploaded, e.g. users, are mapped through their external ids
+        for sfdc_object in config["relinkLookupObjects"]:
+            external_id_name = config["externalIds"][sfdc_object]
+            records = sfDestination.get_records(sfdc_object=sfdc_object,
+                                                where_clause=" %s <> NULL " % external_id_name,
+                                                field_list=['Id', external_id_name])
+            db.insert_id_map(sfdc_object, [(record[external_id_name], record['Id']) for record in records])
 
     for sfdc_object in config["entities"]:
+        profiler.start('Upload %s' % sfdc_object)
         # TODO: This needs to be coded, you are seeing old code for desk to sfdc migration!
         batch_size = sfdc_upload_batch_size
         if sfdc_object in config["customBatchSizes"].keys():
             batch_size = config["customBatchSizes"][sfdc_object]
 
-        record_count = db.get_record_count(sfdc_object)
-        logger.info('Found %s %s to upload.', str(record_count), sfdc_object)
+        # make sure tables staged by an earlier version have the tracking fields
+        db.create_table(sfdc_object)
+        # read through a view that swaps the source org Ids in lookups for their destination org Ids
+        source_table = sfdc_object
+        if config["relinkLookups"]:
+            db.refresh_id_map()
+            mapped_objects = list(schema.keys()) + config["relinkLookupObjects"]
+            source_table = db.create_relinked_view(sfdc_object, mapped_objects, relink_defaults) or sfdc_object
+            for field, total in db.get_unresolved_lookups(sfdc_object, mapped_objects).items():
+                logger.warning('%s %s records have a %s that is not mapped to the destination org, it is replaced by '
+                               'its relinkDefaults Id if any, or sent unchanged', total, sfdc_object, field)
+
+        if args.retry_failed:
+            # read the rejected records up front, the failures table shrinks as they make it in
+            failed_records = db.get_records(source_table, where_clause=db.get_failed_records_clause(sfdc_object))
+            batch_size = config["retryBatchSize"]
+            record_count = len(failed_records)
+            logger.info('Found %s failed %s to retry.', str(record_count), sfdc_object)
+        else:
+            record_count = db.get_record_count(sfdc_object)
+            logger.info('Found %s %s to upload.', str(record_count), sfdc_object)
         # let's upload in batches of 10000
         bar = Bar(sfdc_object, max=record_count)
-        total_batches = int(ceil(record_count / batch_size))
-
-        for batch in range(total_batches):
-            records = db.get_records(sfdc_object, batch_size, batch_size * batch)
-            res = sfDestination.upload_records(sfdc_object, records, config["includeAuditFields"])
-            bar_next(bar, batch_size)
-            # now update the external id with the Salesforce Id
-            if res is not None:
-                db.update_external_ids(sfdc_object, res, config["externalIds"][sfdc_object])
+        batches = read_batches(source_table, batch_size, failed_records if args.retry_failed else None)
+        counts = {"sent": 0, "skipped": 0}
+        if config["skipUnchanged"]:
+            batches = select_changed(batches, config["externalIds"][sfdc_object], counts, bar)
+        else:
+            batches = to_payloads(batches, config["externalIds"][sfdc_object])
+
+        if config["pipelinedUpload"]:
+            # one Bulk job per object, the results are stored while the next batches are still being processed
+            with destination_scheduler.slot():
+                sfDestination.upload_records_pipelined(sfdc_object, batches, config["externalIds"][sfdc_object],
+                                                       functools.partial(store_upload_results, sfdc_object,
+                                                                         progress_bar=bar),
+                                                       concurrency_mode=config["bulkConcurrencyMode"],
+                                                       result_threads=destination_scheduler.wait())
+        else:
+            for records in batches:
+                with destination_scheduler.slot():
+                    res = sfDestination.upload_records(sfdc_object, records, config["externalIds"][sfdc_object])
+                if res is None:
+                    res = [(record, '') for record in records]
+                store_upload_results(sfdc_object, res, bar)
         bar.finish()
+        if config["skipUnchanged"]:
+            logger.info('Sent %s %s, skipped %s unchanged since their last upload', counts["sent"], sfdc_object,
+                        counts["skipped"])
+            print('Sent %s %s, skipped %s unchanged since their last upload' % (counts["sent"], sfdc_object,
+                                                                                counts["skipped"]))
+        if db.get_failure_count(sfdc_object) > 0:
+            print('%s %s were rejected, run with --retry-failed once fixed' % (db.get_failure_count(sfdc_object),
+                                                                                sfdc_object))
 
         print("Finished uploading data, please check the Bulk Data Load job status in Salesforce for results.")
+        profiler.stop()
 
     if config["attachments"] is not None:
+        profiler.start('Retrieve Ids')
         id_map = {}
         bar = Bar("Retrieving Ids", max=len(config["attachments"]))
 
@@ -220,7 +418,12 @@ if args.upload:
         total_records = 0
         # first process contentdocument records
         # records = db.get_records('ContentVersion', where_clause=" newId IS NULL AND (FirstPublishLocationId LIKE '001%' OR FirstPublishLocationId LIKE '00Q%' OR FirstPublishLocationId LIKE '003%'  OR FirstPublishLocationId LIKE '02s%' OR FirstPublishLocationId LIKE '006%')")
-        records = db.get_records('ContentVersion', where_clause=" newId IS NULL ")
+        profiler.start('ContentVersion files')
+        where_clause = " newId IS NULL "
+        if args.retry_failed:
+            where_clause += " AND " + db.get_failed_records_clause('ContentVersion')
+        records = db.get_records('ContentVersion', where_clause=where_clause)
+        retried_documents = set(rec["ContentDocumentId"] for rec in records)
         all_attachments = []
         batch = 0
         bar = Bar("ContentDocuments", max=len(records))
@@ -237,12 +440,14 @@ if args.upload:
                     attachments.append(attachment)
                 else:
                     logger.error('Body of contentdocument %s is blank', rec["Id"])
+                    db.record_results('ContentVersion', [(rec, skipped_result('The file body could not be '
+                                                                              'downloaded', ['VersionData']))], 'Id')
             # pool = multiprocessing.Pool(processes=config["threads"])
             # attachments = pool.starmap(fetch_contentversions, params, chunksize=1)
             # pool.close()
             for attachment in attachments:
 
-                if attachment["VersionData"] is None:
+                if "VersionData" in attachment and attachment["VersionData"] is None:
                     continue
 
                 if attachment["FirstPublishLocationId"] is None or attachment['FirstPublishLocationId'] not in id_map:
@@ -264,8 +469,8 @@ if args.upload:
                 attachment['CreatedById'] = attachment['OwnerId']
 
                 # it it a large file? upload separately
-                if rec_map[attachment[config["externalIds"]["ContentVersion"]]]['ContentSize'] > '10000000':
-                    threading.Timer(1.0, upload_contentversions, [sfDestination, [attachment], False]).start()
+                if is_large_file(rec_map[attachment[config["externalIds"]["ContentVersion"]]]):
+                    upload_in_background(upload_large_contentversion, [sfSource, sfDestination, attachment])
                     continue
                 else:
                     all_attachments.append(attachment)
@@ -273,14 +478,15 @@ if args.upload:
                 if batch >= config["customBatchSizes"]["Attachment"] - 1:
                     # print(all_attachments)
                     if len(all_attachments) > 0:
-                        threading.Timer(1.0, upload_contentversions, [sfDestination, all_attachments]).start()
+                        upload_in_background(upload_contentversions, [sfDestination, all_attachments])
                     batch = 0
                     all_attachments = []
                 else:
                     batch += 1
             bar_next(bar, config["threads"])
         if len(all_attachments) > 0:
-            upload_contentversions(sfDestination, all_attachments)
+            with destination_scheduler.slot():
+                upload_contentversions(sfDestination, all_attachments)
         bar.finish()
         print(
             "Finished uploading ContentVersion, please check the Bulk Data Load job status in Salesforce for results.")
@@ -288,8 +494,11 @@ if args.upload:
         # first process contentdocument link records
         # download all content document links, this is a complex process as they need to be query by document ids
         # documents = sfSource.get_records('ContentDocument', field_list=['Id'])
-        db.db.execute('SELECT DISTINCT ContentDocumentId Id from ContentVersion WHERE newId IS NOT NULL')
-        documents = db.db.fetchall()
+        profiler.start('ContentDocumentLinks')
+        documents = db.query('SELECT DISTINCT ContentDocumentId Id from ContentVersion WHERE newId IS NOT NULL')
+        if args.retry_failed:
+            # the links of the files uploaded before were downloaded and uploaded along with them
+            documents = [document for document in documents if document['Id'] in retried_documents]
 
         batch_size = 150
         total_batches = int(ceil(len(documents) / batch_size))
@@ -297,18 +506,26 @@ if args.upload:
         documents_grouped = group_records(documents, total_batches)
         bar = Bar("ContentDocumentLinks Download", max=len(documents))
         for group in documents_grouped:
-            links = sfSource.get_contentdocumentlinks([r['Id'] for r in group])
+            links = sfSource.get_contentdocumentlinks([r['Id'] for r in group],
+                                                      db.get_fields('ContentDocumentLink')
+                                                      if config["projectToDestination"] else None)
             db.insert_records('ContentDocumentLink', links)
             bar_next(bar, batch_size)
         bar.finish()
 
         # then map them to the new ids and upload them
-        db.db.execute(
-            "SELECT LinkedEntityId, CV.ContentDocumentId ContentDocumentId, ShareType, Visibility, CV.newId newId "
+        where_clause = "CV.newId IS NOT NULL"
+        if args.retry_failed:
+            # the links of the files retried in this run, and the links rejected during a previous run
+            where_clause += " AND (ContentDocumentLink.ContentDocumentId IN (%s) OR %s)" % (
+                ', '.join("'%s'" % document['Id'] for document in documents),
+                db.get_failed_records_clause('ContentDocumentLink', 'ContentDocumentLink.Id'))
+        records = db.query(
+            "SELECT ContentDocumentLink.Id Id, LinkedEntityId, CV.ContentDocumentId ContentDocumentId, ShareType, "
+            "Visibility, CV.newId newId "
             "FROM ContentDocumentLink "
             "INNER JOIN ContentVersion CV ON CV.ContentDocumentId = ContentDocumentLink.ContentDocumentId "
-            "WHERE CV.newId IS NOT NULL")
-        records = db.db.fetchall()
+            "WHERE " + where_clause)
         # get the  content version records from salesforce so we can derive the new ContentDocumentId
         content_versions = sfDestination.get_records("ContentVersion", field_list=["Id", "ContentDocumentId"],
                                                      where_clause=" isLatest = true  AND FileExtension != 'snote' ")
@@ -317,9 +534,15 @@ if args.upload:
             content_versions_map[cv["Id"]] = cv["ContentDocumentId"]
 
         cls = []
+        link_ids = []
+        unresolved = []
+        unresolved_ids = []
         for record in records:
             if record["newId"] not in content_versions_map:
                 logger.error('content_versions_map does not contain %s', record["newId"])
+                unresolved.append((record, skipped_result('ContentVersion %s was not found in the destination org'
+                                                          % record["newId"], ['ContentDocumentId'])))
+                unresolved_ids.append(record["Id"])
                 continue
             # transform the Ids
             # print(record)
@@ -332,12 +555,22 @@ if args.upload:
             if record["LinkedEntityId"] in id_map:
                 cl["LinkedEntityId"] = id_map[record["LinkedEntityId"]]["Id"]
                 cls.append(cl)
+                link_ids.append(record["Id"])
             else:
                 logger.error('Could not find a ContentDocumentLink linked Id for %s', record["LinkedEntityId"])
-        ress = sfDestination.upload_records('ContentDocumentLink', cls, False, upsert=False)
-
+                unresolved.append((cl, skipped_result('Linked record %s was not migrated' % record["LinkedEntityId"],
+                                                      ["LinkedEntityId"])))
+                unresolved_ids.append(record["Id"])
+        ress = []
+        if cls:
+            with destination_scheduler.slot():
+                ress = sfDestination.upload_records('ContentDocumentLink', cls, False, upsert=False)
+            if ress is None:
+                ress = [(cl, '') for cl in cls]
+
+        store_contentdocumentlink_results(link_ids + unresolved_ids, ress + unresolved)
         for res in ress:
-            if not res[1]['success']:
+            if res[1] and not res[1]['success']:
                 if res[1]['errors'] and "already linked" not in res[1]['errors'][0]['message']:
                     logger.error('Error uploading ContentDocumentLink for ContentDocumentId %s and LinkedEntityId %s '
                                  'with error %s ', res[0]['ContentDocumentId'], res[0]['LinkedEntityId'],
@@ -348,21 +581,36 @@ if args.upload:
         print("Finished uploading data, please check the Bulk Data Load job status in Salesforce for results.")
 
         # then process attachment records
-        records = db.get_records('Attachment', where_clause=" newId IS NULL ")
+        profiler.start('Attachment files')
+        where_clause = " newId IS NULL "
+        if args.retry_failed:
+            where_clause += " AND " + db.get_failed_records_clause('Attachment')
+        records = db.get_records('Attachment', where_clause=where_clause)
         all_attachments = []
         batch = 0
         bar = Bar("Attachments", max=len(records))
-        grouped = group_records(records, config["threads"])
-        for group in grouped:
+        index = 0
+        while index < len(records):
+            # fetch as many bodies at once as the source org's API headroom allows
+            threads = source_scheduler.wait()
+            group = records[index:index + threads]
+            index += threads
             params = []
             for rec in group:
                 params.append((sfSource, rec))
-            pool = multiprocessing.Pool(processes=config["threads"])
-            attachments = pool.starmap(fetch_attachments, params, chunksize=1)
+            pool = multiprocessing.Pool(processes=threads)
+            fetched = pool.starmap(fetch_attachments, params, chunksize=1)
             pool.close()
+            attachments = []
+            for attachment, api_usage in fetched:
+                sfSource.merge_api_usage(api_usage)
+                attachments.append(attachment)
+            orphans = []
             for attachment in attachments:
                 if attachment['ParentId'] not in id_map:
                     logger.error('Could not find a Attachment parent Id for %s', attachment['ParentId'])
+                    orphans.append((attachment, skipped_result('Parent record %s was not migrated'
+                                                               % attachment['ParentId'], ['ParentId'])))
                 else:
                     obj_type = id_map[attachment['ParentId']]["Type"]
                     parent_owner_id = id_map[attachment['ParentId']]["OwnerId"]
@@ -378,19 +626,33 @@ if args.upload:
                         attachment['OwnerId'] = parent_owner_id
 
                     all_attachments.append(attachment)
+            if orphans:
+                db.record_results("Attachment", orphans, config["externalIds"]["Attachment"])
 
             if batch > 0:  # sfdc_upload_batch_size / 10:  # arbitrary break down by 1000
                 # print(all_attachments)
-                threading.Timer(1.0, upload_attachments, [sfDestination, all_attachments]).start()
+                upload_in_background(upload_attachments, [sfDestination, all_attachments])
                 batch = 0
                 all_attachments = []
             else:
                 batch += config["threads"]
             bar_next(bar, len(group))
         if len(all_attachments) > 0:
-            upload_attachments(sfDestination, all_attachments)
+            with destination_scheduler.slot():
+                upload_attachments(sfDestination, all_attachments)
         bar.finish()
         print("Finished uploading attachments, please check the Bulk Data Load job status in Salesforce for results.")
+        profiler.stop()
+
+if args.profile:
+    profile_summary = profiler.summary()
+    print(profile_summary)
+    logger.info('Profile summary:\n%s', profile_summary)
+
+# wait for the background uploads to store their results, and for the last writes to be committed
+for thread in list(background_uploads):
+    thread.join()
+db.close()
 
 # print some success/error info
 warning_count = 0
@@ -0,0 +1,156 @@
+from math import ceil
+
+# REST calls made by one Bulk API batch: create job, add batch, poll status, fetch results and close job
+bulk_calls_per_batch = 5
+# ContentDocumentLinks are queried for this many ContentDocumentIds at a time
+links_query_size = 150
+# base64 encoding inflates file bodies sent through the API by a third
+base64_ratio = 4 / 3
+# rough size of a single field value when nothing has been staged yet
+default_field_size = 20
+
+
+def plan_phase(name, org, records=0, bulk_batches=0, rest_calls=0, bytes_transferred=0, throughput=None):
+    """ estimate the API usage and duration of a single migration phase """
+    api_calls = bulk_batches * bulk_calls_per_batch + rest_calls
+    seconds = 0
+    if throughput:
+        seconds += records / throughput["bulkRecordsPerSecond"] if bulk_batches else 0
+        seconds += rest_calls / throughput["restCallsPerSecond"]
+        seconds += bytes_transferred / throughput["bytesPerSecond"]
+    return {
+        "name": name,
+        "org": org,
+        "records": records,
+        "bulk_batches": bulk_batches,
+        "rest_calls": rest_calls,
+        "api_calls": api_calls,
+        "bytes": int(bytes_transferred),
+        "seconds": seconds,
+        "flags": []
+    }
+
+
+def record_size(db, sfdc_object, schema):
+    size = db.get_average_record_size(sfdc_object)
+    if size is None:
+        size = len(schema[sfdc_object]["fields"]) * default_field_size
+    return size
+
+
+def build_plan(config, sf_source, db, schema, upload_batch_size):
+    throughput = config["measuredThroughput"]
+    entities = list(config["entities"])
+    if config["includeAttachments"]:
+        entities.extend(['ContentVersion', 'Attachment'])
+    custom_batch_sizes = config["customBatchSizes"]
+    counts = {}
+    plan = []
+
+    for sfdc_object in entities:
+        # count what the download will fetch, not everything the org holds
+        counts[sfdc_object] = sf_source.get_record_count(
+            sfdc_object, sf_source.get_download_where_clause(sfdc_object, config["queryFilter"]))
+        if config["recordLimit"] is not None:
+            counts[sfdc_object] = min(counts[sfdc_object], config["recordLimit"])
+        size = record_size(db, sfdc_object, schema)
+        plan.append(plan_phase('Download %s' % sfdc_object, 'source', counts[sfdc_object], 1, 1,
+                               counts[sfdc_object] * size, throughput))
+
+    for sfdc_object in config["entities"]:
+        batch_size = custom_batch_sizes.get(sfdc_object, upload_batch_size)
+        size = record_size(db, sfdc_object, schema)
+        plan.append(plan_phase('Upload %s' % sfdc_object, 'destination', counts[sfdc_object],
+                               int(ceil(counts[sfdc_object] / batch_size)), 0, counts[sfdc_object] * size,
+                               throughput))
+
+    if config["attachments"] is None:
+        return plan
+
+    plan.append(plan_phase('Retrieve Ids', 'destination', bulk_batches=len(config["attachments"]),
+                           throughput=throughput))
+
+    # the staged file sizes tell us how many bytes will go through both orgs
+    files = db.get_field_sum('ContentVersion', 'ContentSize', ' newId IS NULL ')
+    large_files = db.get_field_sum('ContentVersion', 'ContentSize',
+                                   ' newId IS NULL AND CAST(ContentSize AS INTEGER) > %s ' % sf_source.large_file_size)
+    if files is None or large_files is None:
+        files = (counts.get('ContentVersion', 0), 0)
+        large_files = (0, 0)
+    small_count = files[0] - large_files[0]
+    # large files are streamed as binary, the others are sent base64 encoded
+    plan.append(plan_phase('Fetch ContentVersion bodies', 'source', files[0], 0, files[0], files[1], throughput))
+    plan.append(plan_phase('Upload ContentVersion', 'destination', files[0],
+                           int(ceil(small_count / custom_batch_sizes["Attachment"])), large_files[0],
+                           (files[1] - large_files[1]) * base64_ratio + large_files[1], throughput))
+
+    link_queries = int(ceil(files[0] / links_query_size))
+    plan.append(plan_phase('Download ContentDocumentLink', 'source', files[0], 0, link_queries, 0, throughput))
+    plan.append(plan_phase('Upload ContentDocumentLink', 'destination', files[0],
+                           int(ceil(files[0] / upload_batch_size)), 1, 0, throughput))
+
+    attachments = db.get_field_sum('Attachment', 'BodyLength', ' newId IS NULL ')
+    if attachments is None:
+        attachments = (counts.get('Attachment', 0), 0)
+    plan.append(plan_phase('Fetch Attachment bodies', 'source', attachments[0], 0, attachments[0], attachments[1],
+                           throughput))
+    # attachments are uploaded every other group of threads
+    plan.append(plan_phase('Upload Attachment', 'destination', attachments[0],
+                           int(ceil(attachments[0] / (config["threads"] * 2))), 0,
+                           attachments[1] * base64_ratio, throughput))
+    return plan
+
+
+def check_limits(plan, org, limits):
+    """ flag the phases during which the remaining daily limits of the org run out """
+    if limits is None:
+        return
+    remaining_api_calls = limits.get("DailyApiRequests", {}).get("Remaining")
+    remaining_batches = limits.get("DailyBulkApiBatches", limits.get("DailyBulkApiRequests", {})).get("Remaining")
+    api_calls = 0
+    bulk_batches = 0
+    for phase in plan:
+        if phase["org"] != org:
+            continue
+        api_calls += phase["api_calls"]
+        bulk_batches += phase["bulk_batches"]
+        if remaining_api_calls is not None and api_calls > remaining_api_calls:
+            phase["flags"].append('exceeds %s daily API requests (%s remaining)' % (org, remaining_api_calls))
+        if remaining_batches is not None and bulk_batches > remaining_batches:
+            phase["flags"].append('exceeds %s daily Bulk API batches (%s remaining)' % (org, remaining_batches))
+
+
+def check_window(plan, window_seconds):
+    """ flag the phases that would still be running after the maintenance window closes """
+    seconds = 0
+    for phase in plan:
+        seconds += phase["seconds"]
+        if seconds > window_seconds:
+            phase["flags"].append('exceeds maintenance window')
+
+
+def format_plan(plan):
+    lines = ['%-40s %-12s %10s %8s %8s %10s %14s %10s' % ('Phase', 'Org', 'Records', 'Batches', 'REST',
+                                                           'API calls', 'Bytes', 'Duration')]
+    totals = plan_phase('Total', '', throughput=None)
+    for phase in plan:
+        lines.append(format_phase(phase))
+        for flag in phase["flags"]:
+            lines.append('    !! %s' % flag)
+        for key in ["records", "bulk_batches", "rest_calls", "api_calls", "bytes", "seconds"]:
+            totals[key] += phase[key]
+    lines.append(format_phase(totals))
+    return '\n'.join(lines)
+
+
+def format_phase(phase):
+    return '%-40s %-12s %10s %8s %8s %10s %14s %10s' % (phase["name"], phase["org"], phase["records"],
+                                                        phase["bulk_batches"], phase["rest_calls"],
+                                                        phase["api_calls"], phase["bytes"],
+                                                        format_duration(phase["seconds"]))
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
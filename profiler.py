@@ -0,0 +1,74 @@
+import cProfile
+import pstats
+import re
+import time
+import tracemalloc
+
+
+class Profiler:
+    enabled = False
+    output_path = "./"
+    run_name = None
+    logger = None
+    # number of functions listed per phase in the summary
+    top = 10
+    phases = None
+    current = None
+
+    def __init__(self, enabled, output_path, run_name, logger, top=10):
+        self.enabled = enabled
+        self.output_path = output_path
+        self.run_name = run_name
+        self.logger = logger
+        self.top = top
+        self.phases = []
+        if self.enabled:
+            tracemalloc.start()
+
+    def start(self, name):
+        """ start profiling a phase, the phase that was running (if any) is stopped first """
+        if not self.enabled:
+            return
+        if self.current is not None:
+            self.stop()
+        tracemalloc.reset_peak()
+        self.current = {
+            "name": name,
+            "profile": cProfile.Profile(),
+            "start": time.time(),
+            "memory": tracemalloc.get_traced_memory()[0]
+        }
+        self.current["profile"].enable()
+
+    def stop(self):
+        if not self.enabled or self.current is None:
+            return
+        phase = self.current
+        self.current = None
+        phase["profile"].disable()
+        phase["seconds"] = time.time() - phase["start"]
+        phase["peak_memory"] = tracemalloc.get_traced_memory()[1] - phase["memory"]
+        phase["path"] = '%s%s-%s.prof' % (self.output_path, self.run_name, re.sub(r'\W+', '_', phase["name"]))
+        try:
+            phase["profile"].dump_stats(phase["path"])
+        except OSError as e:
+            self.logger.error('Error writing profile of phase %s: %s', phase["name"], e)
+        phase["stats"] = pstats.Stats(phase["profile"])
+        del phase["profile"]
+        self.phases.append(phase)
+        self.logger.info('Phase %s took %.1fs, allocating up to %.1f MB more at its peak', phase["name"],
+                         phase["seconds"], phase["peak_memory"] / 1048576)
+
+    def summary(self):
+        """ the slowest functions of each phase, by time spent in the function itself """
+        self.stop()
+        lines = []
+        for phase in self.phases:
+            lines.append('%s: %.1fs, peak memory +%.1f MB, profile: %s' % (phase["name"], phase["seconds"],
+                                                                          phase["peak_memory"] / 1048576,
+                                                                          phase["path"]))
+            hotspots = sorted(phase["stats"].stats.items(), key=lambda item: item[1][2], reverse=True)
+            for (file_name, line, function), (_, calls, own_time, cumulative_time, _) in hotspots[:self.top]:
+                lines.append('    %8.2fs own %8.2fs cumulative %10s calls  %s (%s:%s)' % (
+                    own_time, cumulative_time, calls, function, file_name, line))
+        return '\n'.join(lines)
@@ -0,0 +1,80 @@
+import threading
+from contextlib import contextmanager
+from math import ceil
+
+
+class ApiScheduler:
+    """ decides how many API calls may run at once against an org, based on its remaining daily API requests
+
+    Concurrency scales linearly from min_threads to max_threads with the headroom left above the reserve, and drops
+    to zero (callers wait) once the org gets within reserve requests of its daily limit.
+    """
+    client = None
+    logger = None
+    reserve = 0
+    min_threads = 1
+    max_threads = 1
+    default_threads = 1
+    # seconds to wait before checking the org limits again when there is no headroom left
+    wait_seconds = 60
+    active = 0
+    condition = None
+    # whether the org limits were asked for because no response reported the API usage yet
+    limits_checked = False
+
+    def __init__(self, client, reserve, min_threads, max_threads, default_threads, logger, wait_seconds=60):
+        self.client = client
+        self.reserve = reserve
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.default_threads = default_threads
+        self.logger = logger
+        self.wait_seconds = wait_seconds
+        self.condition = threading.Condition()
+
+    def concurrency(self):
+        if self.client.api_usage is None and not self.limits_checked:
+            self.limits_checked = True
+            self.client.refresh_api_usage()
+        if self.client.api_usage is None:
+            return self.default_threads
+        used, total = self.client.api_usage
+        headroom = total - used - self.reserve
+        if headroom <= 0:
+            return 0
+        ratio = headroom / max(total - self.reserve, 1)
+        return min(self.max_threads, self.min_threads + int(ceil((self.max_threads - self.min_threads) * ratio)))
+
+    def wait(self):
+        """ block until the org has headroom again, returns the number of calls that may run at once """
+        with self.condition:
+            return self._wait_for_headroom()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self._wait_for_headroom():
+                self.condition.wait(1)
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _wait_for_headroom(self):
+        allowed = self.concurrency()
+        while allowed == 0:
+            self.logger.warning('Only %s API requests left with a reserve of %s to keep, waiting %ss',
+                                self.client.api_usage[1] - self.client.api_usage[0], self.reserve, self.wait_seconds)
+            self.condition.wait(self.wait_seconds)
+            self.client.refresh_api_usage()
+            allowed = self.concurrency()
+        return allowed
@@ -9,7 +9,10 @@ import datetime
 import itertools
 import base64
 import re
+import time
+import uuid
 import transformations
+import bulkjob
 
 
 class SFDCClient(object):
@@ -22,11 +25,26 @@ class SFDCClient(object):
     domain = None
     mappings = None
     file_objects = ['ContentDocument', 'ContentVersion', 'Attachment']
+    # files above this size (in bytes) are uploaded one at a time through the REST API instead of the Bulk API
+    large_file_size = 10000000
+    # large file bodies are streamed in chunks of this many bytes
+    stream_chunk_size = 1048576
     # fields_to_skip = {"Attachment": ["Body"]}
     fields_to_skip = {}
+    # fields the file migration relies on, kept even when the destination can not accept them
+    required_fields = {
+        "ContentVersion": ["Id", "Title", "PathOnClient", "Description", "ContentUrl", "OwnerId", "CreatedDate",
+                           "FirstPublishLocationId", "TagCsv", "ContentSize", "ContentDocumentId"],
+        "Attachment": ["Id", "ParentId", "ContentType", "Name", "OwnerId", "IsPrivate", "BodyLength"],
+        "ContentDocumentLink": ["Id", "LinkedEntityId", "ContentDocumentId", "ShareType", "Visibility"]
+    }
+    describes = None
+    # (used, max) daily API requests, as last reported by Salesforce
+    api_usage = None
 
     def __init__(self, username, password, token, domain, logger):
         self.logger = logger
+        self.describes = {}
         # TODO: Custom Mappings
         # with open('mappings.json') as json_mappings_file:
         #     self.mappings = json.load(json_mappings_file)
@@ -41,9 +59,37 @@ class SFDCClient(object):
             self.logger.error('Error logging into Salesforce: %s', e)
             print('Error logging into Salesforce')
 
+    def __getstate__(self):
+        # the describe cache is not sent along when the client is passed to a child process
+        state = self.__dict__.copy()
+        state['describes'] = {}
+        return state
+
     def create_connection(self):
         self.conn = Salesforce(username=self.username, password=self.password, security_token=self.token,
                                domain=self.domain)
+        # every REST and Bulk API response reports the org's API usage
+        self.conn.session.hooks['response'].append(self.track_api_usage)
+
+    def track_api_usage(self, response, *args, **kwargs):
+        limit_info = response.headers.get('Sforce-Limit-Info')
+        if limit_info:
+            usage = re.search(r'api-usage=(\d+)/(\d+)', limit_info)
+            if usage:
+                self.api_usage = (int(usage.group(1)), int(usage.group(2)))
+        return response
+
+    def refresh_api_usage(self):
+        limits = self.get_limits()
+        if limits is not None and "DailyApiRequests" in limits:
+            daily = limits["DailyApiRequests"]
+            self.api_usage = (daily["Max"] - daily["Remaining"], daily["Max"])
+        return self.api_usage
+
+    def merge_api_usage(self, api_usage):
+        """ take in the usage reported to a copy of this client, e.g. the one a child process worked with """
+        if api_usage is not None and (self.api_usage is None or api_usage[0] > self.api_usage[0]):
+            self.api_usage = api_usage
 
     def check_connection(self):
         try:
@@ -54,13 +100,10 @@ class SFDCClient(object):
             self.logger.error('Error connecting to Salesforce: %s', e)
 
     def get_records(self, sfdc_object, limit=None, where_clause=None, field_list=None):
-        all_fields_string = self.get_all_fields_string(sfdc_object)
-        # TODO: this is a quick fix, not foolproof!
+        all_fields = self.get_all_fields(sfdc_object)
         if field_list:
-            for field in field_list:
-                if field not in all_fields_string:
-                    field_list.remove(field)
-        field_list_string = ','.join(field_list) if field_list else all_fields_string
+            field_list = [field for field in field_list if field in all_fields]
+        field_list_string = ','.join(field_list) if field_list else ','.join(all_fields)
         soql = "SELECT %s FROM %s" % (field_list_string, sfdc_object)
         if where_clause is not None:
             soql += ' WHERE %s' % where_clause
@@ -85,10 +128,12 @@ class SFDCClient(object):
 
     def upload_records(self, sfdc_object, records,  external_id, upsert=True):
         try:
+            # staged records are read-only Records, the Bulk API client only serializes dicts
+            payload = [dict(record) for record in records]
             if upsert:
-                res = self.conn.bulk.__getattr__(sfdc_object).upsert(records, external_id)
+                res = self.conn.bulk.__getattr__(sfdc_object).upsert(payload, external_id)
             else:
-                res = self.conn.bulk.__getattr__(sfdc_object).insert(records)
+                res = self.conn.bulk.__getattr__(sfdc_object).insert(payload)
             self.logger.info(
                 "Uploaded a batch of %s, please check the Bulk Data Load job status in Salesforce for results.",
                 sfdc_object)
@@ -98,29 +143,121 @@ class SFDCClient(object):
             # self.logger.error('with records: %s', sfdc_records)
             return None
 
+    def upload_records_pipelined(self, sfdc_object, batches, external_id, on_results, upsert=True,
+                                 concurrency_mode='Parallel', result_threads=4):
+        """ submit every batch to one Bulk job without waiting for the previous one, the (record, result) pairs of
+        each batch are handed to on_results as soon as Salesforce has processed it """
+        job = bulkjob.BulkJob(self.conn, sfdc_object, 'upsert' if upsert else 'insert', external_id,
+                              concurrency_mode, max_workers=result_threads)
+        submitted = 0
+        finished = False
+        # the batch read from batches but not accepted by Salesforce yet
+        unsubmitted = None
+        try:
+            self.check_connection()
+            job.open()
+            last_poll = time.time()
+            for records in batches:
+                unsubmitted = records
+                job.submit(records)
+                unsubmitted = None
+                submitted += len(records)
+                # pick up the batches Salesforce already finished while the next one is being read
+                if time.time() - last_poll >= job.poll_interval:
+                    last_poll = time.time()
+                    pairs = job.poll()
+                    if pairs:
+                        on_results(pairs)
+            job.close()
+            for pairs in job.wait():
+                on_results(pairs)
+            finished = True
+            self.logger.info("Uploaded %s %s in Bulk Data Load job %s", submitted, sfdc_object, job.job_id)
+        except Exception as e:
+            self.logger.error('Error uploading %s into Salesforce: %s', sfdc_object, e)
+            # the batches submitted but not processed yet, and the ones that were never submitted, all failed
+            for records in job.pending.values():
+                on_results([(record, '') for record in records])
+            job.pending = {}
+            if unsubmitted is not None:
+                on_results([(record, '') for record in unsubmitted])
+            for records in batches:
+                on_results([(record, '') for record in records])
+        finally:
+            if job.job_id is not None and not finished:
+                try:
+                    job.abort()
+                except Exception as e:
+                    self.logger.error('Error aborting Bulk Data Load job %s: %s', job.job_id, e)
+        return submitted
+
     def get_schema(self, sfdc_objects):
         schema = {}
         additional_objects = ['ContentVersion', 'Attachment', 'ContentDocumentLink']
         for obj in sfdc_objects:
             schema[obj] = {'fields': {}}
-            for field in self.get_all_fields(obj):
-                schema[obj]['fields'][field] = {}
+            for field in self.get_all_field_describes(obj):
+                schema[obj]['fields'][field['name']] = {'type': field['type'], 'length': field['length'],
+                                                        'referenceTo': field['referenceTo']}
         for obj in additional_objects:
             schema[obj] = {'fields': {}}
-            for field in self.get_all_fields(obj):
-                schema[obj]['fields'][field] = {}
+            for field in self.get_all_field_describes(obj):
+                schema[obj]['fields'][field['name']] = {'type': field['type'], 'length': field['length'],
+                                                        'referenceTo': field['referenceTo']}
         return schema
 
-    def get_all_fields(self, sfdc_object):
-        desc = self.conn.__getattr__(sfdc_object).describe()
-        field_names = []
+    def describe(self, sfdc_object):
+        # describes do not change during a run, so only ask Salesforce once per object
+        if sfdc_object not in self.describes:
+            self.describes[sfdc_object] = self.conn.__getattr__(sfdc_object).describe()
+        return self.describes[sfdc_object]
+
+    def get_all_field_describes(self, sfdc_object):
+        desc = self.describe(sfdc_object)
+        fields = []
         for field in desc['fields']:
             if field['type'] != 'address' and (sfdc_object not in self.fields_to_skip \
                                                or field['name'] not in self.fields_to_skip[sfdc_object]):
-                field_names.append(field['name'])
+                fields.append(field)
+
+        return fields
 
+    def get_all_fields(self, sfdc_object):
+        return [field['name'] for field in self.get_all_field_describes(sfdc_object)]
+
+    def get_accepted_fields(self, sfdc_object):
+        """ names of the fields that can be written to when records are created or updated """
+        field_names = []
+        for field in self.describe(sfdc_object)['fields']:
+            if field['createable'] or field['updateable']:
+                field_names.append(field['name'])
         return field_names
 
+    def project_schema(self, schema, destination, namespaces, required_fields=None):
+        """ reduce the schema to the fields the destination org can accept, returns the skipped fields per object """
+        skipped = {}
+        for sfdc_object in schema:
+            try:
+                accepted_fields = destination.get_accepted_fields(
+                    transformations.transform_object(sfdc_object, namespaces))
+            except Exception as e:
+                self.logger.error('Error describing %s in the destination org, keeping all fields: %s', sfdc_object, e)
+                continue
+            keep = set(self.required_fields.get(sfdc_object, ['Id']))
+            if required_fields and sfdc_object in required_fields:
+                keep.update(required_fields[sfdc_object])
+            fields = {}
+            skipped[sfdc_object] = []
+            types = {field['name']: field['type'] for field in self.describe(sfdc_object)['fields']}
+            for field in schema[sfdc_object]['fields']:
+                if field in keep or (types.get(field) != 'base64' and
+                                     transformations.strip_namespaces(field, namespaces) in accepted_fields):
+                    fields[field] = schema[sfdc_object]['fields'][field]
+                else:
+                    skipped[sfdc_object].append(field)
+            schema[sfdc_object]['fields'] = fields
+        return skipped
+
     def get_all_fields_string(self, sfdc_object):
         fields = self.get_all_fields(sfdc_object)
         return ','.join(fields)
@@ -135,8 +272,8 @@ class SFDCClient(object):
         url = "https://%s%s" % (self.conn.sf_instance, content_link)
         # print('Retrieving: ', url)
         try:
-            response = requests.get(url, headers={"Authorization": "OAuth " + self.conn.session_id,
-                                                  "Content-Type": "application/octet-stream"}, timeout=30)
+            response = self.conn.session.get(url, headers={"Authorization": "OAuth " + self.conn.session_id,
+                                                           "Content-Type": "application/octet-stream"}, timeout=30)
 
             if response.ok:
                 return response.content
@@ -148,14 +285,55 @@ class SFDCClient(object):
             return
 
 
-    def get_record_count(self, sfdc_object):
+    def download_filebody(self, content_link, file):
+        """ write the body of a file into the given file object chunk by chunk, returns False on failure """
+        url = "https://%s%s" % (self.conn.sf_instance, content_link)
+        try:
+            with self.conn.session.get(url, headers={"Authorization": "OAuth " + self.conn.session_id,
+                                                     "Content-Type": "application/octet-stream"},
+                                       timeout=30, stream=True) as response:
+                if not response.ok:
+                    self.logger.error('Error retrieving file contents for %s', content_link)
+                    return False
+                for chunk in response.iter_content(chunk_size=self.stream_chunk_size):
+                    file.write(chunk)
+            return True
+        except Exception as e:
+            self.logger.error('Error retrieving file body for %s, %s', content_link, e)
+            return False
+
+    def get_record_count(self, sfdc_object, where_clause=None):
         soql = "SELECT count() FROM %s " % sfdc_object
+        if where_clause is not None:
+            soql += ' WHERE %s' % where_clause
         res = self.conn.query(soql)
         return res["totalSize"]
 
-    def get_contentdocumentlinks(self, content_document_ids):
+    @staticmethod
+    def get_download_where_clause(sfdc_object, query_filter):
+        """ the filter the records of an object are downloaded with, None when all of them are """
+        where_clause = None
+        if sfdc_object == 'ContentVersion':
+            where_clause = " isLatest = true  AND FileExtension != 'snote'"
+        if query_filter is not None:
+            if where_clause is not None:
+                where_clause += " AND "
+            else:
+                where_clause = ""
+            where_clause += query_filter
+        return where_clause
+
+    def get_limits(self):
+        try:
+            return self.conn.limits()
+        except Exception as e:
+            self.logger.error('Error retrieving org limits from Salesforce: %s', e)
+            return None
+
+    def get_contentdocumentlinks(self, content_document_ids, field_list=None):
+        field_list_string = ','.join(field_list) if field_list else self.get_all_fields_string('ContentDocumentLink')
         soql = "SELECT %s  FROM ContentDocumentLink " \
-               "WHERE ContentDocumentId IN (%s)" % (self.get_all_fields_string('ContentDocumentLink'),
+               "WHERE ContentDocumentId IN (%s)" % (field_list_string,
                                                     ', '.join("'{0}'".format(w) for w in content_document_ids))
         res = self.conn.query(soql)
         return res["records"]
@@ -163,14 +341,16 @@ class SFDCClient(object):
 
     @staticmethod
     def create_content(content, body, external_id):
-        byte_string = str(base64.b64encode(body))
-        # Trim the leading b' and trailing apostrophe.
-        byte_string = byte_string[2:-1]
+        cv = SFDCClient.create_content_metadata(content, external_id)
+        cv["VersionData"] = base64.b64encode(body).decode('ascii')
+        return cv
+
+    @staticmethod
+    def create_content_metadata(content, external_id):
         cv = {
             "title": content["Title"],
             'PathOnClient': content["PathOnClient"],
             "Description": content["Description"],
-            "VersionData": byte_string,
             "ContentUrl": content["ContentUrl"],
             "OwnerId": content["OwnerId"],
             "CreatedById": content["OwnerId"],
@@ -183,9 +363,7 @@ class SFDCClient(object):
 
     @staticmethod
     def create_attachment(attachment, body):
-        byte_string = str(base64.b64encode(body))
-        # Trim the leading b' and trailing apostrophe.
-        byte_string = byte_string[2:-1]
+        byte_string = base64.b64encode(body).decode('ascii')
         cv = {
             "ParentId": attachment["ParentId"],
             'Body': byte_string,
@@ -219,6 +397,43 @@ class SFDCClient(object):
             self.logger.error('Error uploading ContentVersions into Salesforce: %s', e)
             return None
 
+    def upload_contentversion_stream(self, content, body):
+        """ insert a ContentVersion with its body read from the given file object as multipart/form-data, sent
+        with chunked transfer encoding so memory use does not depend on the size of the file """
+        boundary = 'boundary_%s' % uuid.uuid4().hex
+        try:
+            self.check_connection()
+            response = self.conn.session.post(self.conn.base_url + 'sobjects/ContentVersion/',
+                                              data=self.multipart_body(boundary, content, body),
+                                              headers={"Authorization": "Bearer " + self.conn.session_id,
+                                                       "Content-Type": 'multipart/form-data; boundary="%s"'
+                                                                       % boundary})
+            res = response.json()
+            if not response.ok:
+                res = {"success": False, "id": None,
+                       "errors": [{"statusCode": error.get("errorCode"), "message": error.get("message"),
+                                   "fields": error.get("fields")} for error in res]}
+                self.logger.error('Error uploading ContentVersion into Salesforce: %s', json.dumps(res["errors"]))
+            return [(content, res)]
+        except Exception as e:
+            self.logger.error('Error uploading ContentVersion into Salesforce: %s', e)
+            return None
+
+    def multipart_body(self, boundary, content, body):
+        yield ('--%s\r\n'
+               'Content-Disposition: form-data; name="entity_content"\r\n'
+               'Content-Type: application/json\r\n\r\n'
+               '%s\r\n'
+               '--%s\r\n'
+               'Content-Disposition: form-data; name="VersionData"; filename="%s"\r\n'
+               'Content-Type: application/octet-stream\r\n\r\n'
+               % (boundary, json.dumps(content), boundary, content["PathOnClient"])).encode('utf-8')
+        chunk = body.read(self.stream_chunk_size)
+        while chunk:
+            yield chunk
+            chunk = body.read(self.stream_chunk_size)
+        yield ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+
     def upload_attachments(self, attachments, use_bulk=True):
         try:
             self.check_connection()
@@ -231,7 +446,7 @@ class SFDCClient(object):
             if success:
                 self.logger.info(
                     "Uploaded a batch of Attachments, please check the Bulk Data Load job status in Salesforce for results.")
-            return itertools.zip_longest(attachments, ress, fillvalue='')
+            return list(itertools.zip_longest(attachments, ress, fillvalue=''))
         except Exception as e:
             self.logger.error('Error uploading Attachments into Salesforce: %s', e)
             return None
@@ -1,4 +1,20 @@
+import email
+import io
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
 import unittest
+from unittest import mock
+
+import bulkjob
+import db
+import planner
+import scheduler
+import sfdc
 
 
 class migrateTests(unittest.TestCase):
@@ -6,5 +22,359 @@ class migrateTests(unittest.TestCase):
         self.assertEqual(True, False)
 
 
+class dbTests(unittest.TestCase):
+    schema = {
+        "EmailMessage": {"fields": {"Id": {"type": "id", "length": 18},
+                                    "Subject": {"type": "string", "length": 255},
+                                    "HtmlBody": {"type": "textarea", "length": 131072}}}
+    }
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.db = db.Db(self.db_path, logging.getLogger('tests'), compress_threshold=100)
+        self.db.create_connection({name: {"fields": dict(table["fields"])} for name, table in self.schema.items()})
+        self.db.create_tables()
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.db_path)
+
+    def test_compressed_text_round_trip(self):
+        body = '<p>Hello world</p>' * 100
+        self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "x" * 200, "HtmlBody": body},
+                                                {"Id": "2", "Subject": "short", "HtmlBody": "<p>short</p>"}])
+        self.assertEqual([{"s": "text", "h": "blob"}, {"s": "text", "h": "text"}],
+                         self.db.query("SELECT typeof(Subject) s, typeof(HtmlBody) h FROM EmailMessage ORDER BY Id"))
+        records = self.db.get_records('EmailMessage', where_clause='1=1')
+        self.assertEqual(body, records[0]["HtmlBody"])
+        self.assertEqual("<p>short</p>", records[1]["HtmlBody"])
+
+    def test_failed_records_are_kept_until_they_succeed(self):
+        self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "a", "HtmlBody": None},
+                                                {"Id": "2", "Subject": "b", "HtmlBody": None}])
+        error = {"success": False, "id": None, "errors": [{"statusCode": "FIELD_INTEGRITY_EXCEPTION",
+                                                           "message": "bad value", "fields": ["Subject"]}]}
+        self.db.record_results('EmailMessage', [({"Id": "1"}, {"success": True, "id": "new1", "errors": []}),
+                                                ({"Id": "2"}, error)], 'Id')
+        failed = self.db.get_records('EmailMessage', where_clause=self.db.get_failed_records_clause('EmailMessage'))
+        self.assertEqual(["2"], [record["Id"] for record in failed])
+
+        self.db.record_results('EmailMessage', [({"Id": "2"}, {"success": True, "id": "new2", "errors": []})], 'Id')
+        self.assertEqual(0, self.db.get_failure_count('EmailMessage'))
+
+    def test_upload_results_are_stored_against_the_source_id(self):
+        self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "a", "HtmlBody": None},
+                                                {"Id": "2", "Subject": "b", "HtmlBody": None}])
+        payloads = [self.db.get_payload(record, 'APS_External_Id__c')
+                    for record in self.db.get_records('EmailMessage')]
+        self.assertNotIn('Id', payloads[0])
+        error = {"success": False, "id": None, "errors": [{"statusCode": "REQUIRED_FIELD_MISSING",
+                                                           "message": "missing", "fields": []}]}
+        results = [(payloads[0], {"success": True, "id": "new1", "errors": []}), (payloads[1], error)]
+        self.db.update_external_ids('EmailMessage', results, 'APS_External_Id__c')
+        self.db.record_results('EmailMessage', results, 'APS_External_Id__c')
+        self.assertEqual([{"Id": "1", "newId": "new1"}, {"Id": "2", "newId": None}],
+                         self.db.query("SELECT Id, newId FROM EmailMessage ORDER BY Id"))
+        failed = self.db.get_records('EmailMessage', where_clause=self.db.get_failed_records_clause('EmailMessage'))
+        self.assertEqual(["2"], [record["Id"] for record in failed])
+
+    def test_relinked_view_maps_lookups_to_new_ids(self):
+        self.db.schema["Task"] = {"fields": {"Id": {"type": "id"},
+                                             "WhatId": {"type": "reference", "referenceTo": ["EmailMessage"]},
+                                             "OwnerId": {"type": "reference", "referenceTo": ["User"]}}}
+        self.db.create_table("Task")
+        self.db.insert_records('EmailMessage', [{"Id": "e1", "Subject": "a", "HtmlBody": None}])
+        self.db.update_external_ids('EmailMessage', [({"Id": "e1"}, {"success": True, "id": "new_e1"})], 'Id')
+        self.db.insert_records('Task', [{"Id": "t1", "WhatId": "e1", "OwnerId": "u1"},
+                                        {"Id": "t2", "WhatId": "e2", "OwnerId": "u2"}])
+        self.db.insert_id_map('User', [("u1", "new_u1")])
+        self.db.refresh_id_map()
+        view = self.db.create_relinked_view('Task', ['EmailMessage', 'Task', 'User'], {"User": "default_user"})
+        records = self.db.get_records(view)
+        self.assertEqual([("new_e1", "new_u1"), ("e2", "default_user")],
+                         [(record["WhatId"], record["OwnerId"]) for record in records])
+        self.assertEqual({"WhatId": 1, "OwnerId": 1},
+                         self.db.get_unresolved_lookups('Task', ['EmailMessage', 'Task', 'User']))
+
+    def test_unchanged_records_are_not_sent_again(self):
+        self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "a", "HtmlBody": None},
+                                                {"Id": "2", "Subject": "b", "HtmlBody": None}])
+        payloads, skipped = self.db.get_changed_payloads(self.db.get_records('EmailMessage'), 'APS_External_Id__c')
+        self.assertEqual((2, 0), (len(payloads), skipped))
+        self.assertEqual({"APS_External_Id__c": "1", "Subject": "a", "HtmlBody": None}, payloads[0])
+
+        results = [(payload, {"success": True, "id": "new" + payload["APS_External_Id__c"], "errors": []})
+                   for payload in payloads]
+        self.db.update_external_ids('EmailMessage', results, 'APS_External_Id__c')
+        self.db.update_hashes('EmailMessage', results, 'APS_External_Id__c')
+        self.db.insert_records('EmailMessage', [{"Id": "2", "Subject": "changed", "HtmlBody": None}])
+        payloads, skipped = self.db.get_changed_payloads(self.db.get_records('EmailMessage'), 'APS_External_Id__c')
+        self.assertEqual((["2"], 1), ([payload["APS_External_Id__c"] for payload in payloads], skipped))
+
+    def test_concurrent_writes_are_all_committed(self):
+        def insert(thread):
+            for i in range(20):
+                self.db.insert_records('EmailMessage', [{"Id": "%s-%s" % (thread, i), "Subject": None,
+                                                         "HtmlBody": None}])
+                self.assertEqual(1, len(self.db.get_records('EmailMessage', where_clause="Id = '%s-%s'" % (thread, i))))
+
+        threads = [threading.Thread(target=insert, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(160, self.db.get_record_count('EmailMessage'))
+
+    def test_writer_survives_an_aborted_transaction(self):
+        def abort(db):
+            # what SQLite does on a full disk or an I/O error
+            db.execute("rollback")
+            raise sqlite3.OperationalError('database or disk is full')
+
+        self.assertIsNone(self.db.write('EmailMessage', abort))
+        self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "a", "HtmlBody": None}])
+        self.assertEqual(1, self.db.get_record_count('EmailMessage'))
+
+    def test_write_fails_once_the_writer_stopped(self):
+        self.db.writes.put(None)
+        self.db.writer.join()
+        with self.assertRaises(sqlite3.Error):
+            self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "a", "HtmlBody": None}])
+
+    def test_records_behave_like_dicts(self):
+        self.db.insert_records('EmailMessage', [{"Id": "1", "Subject": "Hello", "HtmlBody": None}])
+        record = self.db.get_records('EmailMessage', where_clause='1=1')[0]
+        self.assertEqual("Hello", record["Subject"])
+        self.assertIsNone(record.get("Missing"))
+        self.assertIn("HtmlBody", record)
+        self.assertEqual({"Id": "1", "Subject": "Hello", "HtmlBody": None, "newId": None, "newHash": None},
+                         dict(record))
+        self.assertEqual(dict(record), json.loads(json.dumps(record, default=dict)))
+        self.assertEqual(record, pickle.loads(pickle.dumps(record)))
+
+
+class FakeClient:
+    def __init__(self, api_usage=None, refreshed_usages=()):
+        self.api_usage = api_usage
+        self.refreshed_usages = list(refreshed_usages)
+        self.refreshes = 0
+
+    def refresh_api_usage(self):
+        self.refreshes += 1
+        if self.refreshed_usages:
+            self.api_usage = self.refreshed_usages.pop(0)
+        return self.api_usage
+
+
+class schedulerTests(unittest.TestCase):
+    def create_scheduler(self, client, max_threads=8):
+        return scheduler.ApiScheduler(client, 5000, 1, max_threads, 2, logging.getLogger('tests'), wait_seconds=0.01)
+
+    def test_concurrency_scales_with_the_headroom(self):
+        self.assertEqual([8, 5, 2, 0], [self.create_scheduler(FakeClient(usage)).concurrency() for usage in
+                                        [(0, 100000), (50000, 100000), (94999, 100000), (95000, 100000)]])
+
+    def test_limits_are_checked_when_no_usage_was_reported(self):
+        client = FakeClient(refreshed_usages=[(0, 100000)])
+        self.assertEqual(8, self.create_scheduler(client).concurrency())
+
+        client = FakeClient()
+        api_scheduler = self.create_scheduler(client)
+        self.assertEqual((2, 2), (api_scheduler.concurrency(), api_scheduler.concurrency()))
+        self.assertEqual(1, client.refreshes)
+
+    def test_wait_blocks_until_there_is_headroom(self):
+        client = FakeClient((99000, 100000), refreshed_usages=[(99000, 100000), (0, 100000)])
+        self.assertEqual(8, self.create_scheduler(client).wait())
+        self.assertEqual(2, client.refreshes)
+
+    def test_acquire_blocks_until_a_slot_is_released(self):
+        api_scheduler = self.create_scheduler(FakeClient((0, 100000)), max_threads=1)
+        api_scheduler.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            with api_scheduler.slot():
+                acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        api_scheduler.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(0, api_scheduler.active)
+
+
+class sfdcClientTests(unittest.TestCase):
+    def test_describes_are_not_pickled(self):
+        with mock.patch.object(sfdc.SFDCClient, 'create_connection'):
+            client = sfdc.SFDCClient('user', 'password', 'token', None, logging.getLogger('tests'))
+        client.describes['Account'] = {"fields": [{"name": "Name"}] * 1000}
+        client.api_usage = (10, 100)
+        copy = pickle.loads(pickle.dumps(client))
+        self.assertEqual(({}, (10, 100)), (copy.describes, copy.api_usage))
+        self.assertIn('Account', client.describes)
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise Exception('HTTP %s' % self.status_code)
+
+    def json(self):
+        return self.body
+
+
+class FakeBulkSession:
+    """ answers the Bulk API requests of a single job, every batch completes as soon as it is submitted """
+    def __init__(self, failing_batch=None):
+        self.failing_batch = failing_batch
+        self.batches = {}
+        self.requests = []
+
+    def request(self, method, url, headers=None, data=None):
+        path = url[len(FakeConnection.bulk_url):]
+        body = json.loads(data) if data is not None else None
+        self.requests.append((method, path, body))
+        if path == 'job':
+            return FakeResponse({"id": "J1"})
+        if path == 'job/J1/batch' and method == 'POST':
+            if len(self.batches) == self.failing_batch:
+                return FakeResponse({}, 500)
+            batch_id = 'B%s' % len(self.batches)
+            self.batches[batch_id] = body
+            return FakeResponse({"id": batch_id})
+        if path == 'job/J1/batch':
+            return FakeResponse({"batchInfo": [{"id": batch_id, "state": "Completed"} for batch_id in self.batches]})
+        if path.endswith('/result'):
+            return FakeResponse([{"success": True, "id": "new" + record["APS_External_Id__c"], "errors": []}
+                                 for record in self.batches[path.split('/')[3]]])
+        return FakeResponse({})
+
+
+class FakeConnection:
+    bulk_url = 'https://bulk.example.com/'
+    base_url = 'https://rest.example.com/'
+    session_id = 'session'
+
+    def __init__(self, session):
+        self.session = session
+
+    def query(self, soql):
+        return {"records": []}
+
+
+class bulkJobTests(unittest.TestCase):
+    batches = [[{"APS_External_Id__c": "1"}, {"APS_External_Id__c": "2"}], [{"APS_External_Id__c": "3"}],
+               [{"APS_External_Id__c": "4"}]]
+
+    def test_results_are_returned_per_record(self):
+        session = FakeBulkSession()
+        job = bulkjob.BulkJob(FakeConnection(session), 'Account', 'upsert', 'APS_External_Id__c', poll_interval=0)
+        job.open()
+        for records in self.batches:
+            job.submit(records)
+        job.close()
+        pairs = [pair for pairs in job.wait() for pair in pairs]
+        self.assertEqual(["new1", "new2", "new3", "new4"], [result["id"] for record, result in pairs])
+        self.assertEqual([record for records in self.batches for record in records], [record for record, _ in pairs])
+        self.assertEqual(('POST', 'job', {"operation": "upsert", "object": "Account", "contentType": "JSON",
+                                          "concurrencyMode": "Parallel", "externalIdFieldName": "APS_External_Id__c"}),
+                         session.requests[0])
+        self.assertIn(('POST', 'job/J1', {"state": "Closed"}), session.requests)
+
+    def test_failed_upload_aborts_the_job_and_reports_every_batch(self):
+        session = FakeBulkSession(failing_batch=1)
+        with mock.patch.object(sfdc.SFDCClient, 'create_connection'):
+            client = sfdc.SFDCClient('user', 'password', 'token', None, logging.getLogger('tests'))
+        client.conn = FakeConnection(session)
+        results = []
+        client.upload_records_pipelined('Account', iter(self.batches), 'APS_External_Id__c', results.extend)
+        self.assertEqual([("1", ''), ("2", ''), ("3", ''), ("4", '')],
+                         [(record["APS_External_Id__c"], result) for record, result in results])
+        self.assertEqual(('POST', 'job/J1', {"state": "Aborted"}), session.requests[-1])
+
+
+class FakeUploadSession:
+    def __init__(self, response):
+        self.response = response
+        self.sent = None
+
+    def post(self, url, data=None, headers=None):
+        self.sent = (url, b''.join(data), headers)
+        return self.response
+
+
+class contentVersionStreamTests(unittest.TestCase):
+    content = {"Title": "report", "PathOnClient": "report.pdf", "APS_External_Id__c": "068A"}
+
+    def create_client(self, response):
+        with mock.patch.object(sfdc.SFDCClient, 'create_connection'):
+            client = sfdc.SFDCClient('user', 'password', 'token', None, logging.getLogger('tests'))
+        client.conn = FakeConnection(FakeUploadSession(response))
+        client.stream_chunk_size = 4
+        return client
+
+    def test_multipart_body_frames_metadata_and_file(self):
+        client = self.create_client(None)
+        data = b''.join(client.multipart_body('xyz', self.content, io.BytesIO(b'%PDF-1.4 body')))
+        self.assertTrue(data.endswith(b'\r\n--xyz--\r\n'))
+        message = email.message_from_bytes(b'Content-Type: multipart/form-data; boundary="xyz"\r\n\r\n' + data)
+        parts = message.get_payload()
+        self.assertEqual(['entity_content', 'VersionData'], [part.get_param('name', header='content-disposition')
+                                                             for part in parts])
+        self.assertEqual(self.content, json.loads(parts[0].get_payload()))
+        self.assertEqual('report.pdf', parts[1].get_filename())
+        self.assertEqual(b'%PDF-1.4 body', parts[1].get_payload(decode=True))
+
+    def test_error_response_becomes_a_failed_result(self):
+        client = self.create_client(FakeResponse([{"errorCode": "STORAGE_LIMIT_EXCEEDED", "message": "storage full",
+                                                   "fields": []}], 400))
+        res = client.upload_contentversion_stream(self.content, io.BytesIO(b'body'))
+        self.assertEqual([(self.content, {"success": False, "id": None, "errors": [
+            {"statusCode": "STORAGE_LIMIT_EXCEEDED", "message": "storage full", "fields": []}]})], res)
+        url, data, headers = client.conn.session.sent
+        self.assertEqual('https://rest.example.com/sobjects/ContentVersion/', url)
+        self.assertTrue(headers["Content-Type"].startswith('multipart/form-data; boundary='))
+
+
+class FakeSource:
+    get_download_where_clause = staticmethod(sfdc.SFDCClient.get_download_where_clause)
+
+    def __init__(self, count):
+        self.count = count
+        self.where_clauses = {}
+
+    def get_record_count(self, sfdc_object, where_clause=None):
+        self.where_clauses[sfdc_object] = where_clause
+        return self.count
+
+
+class FakeStagingDb:
+    def get_average_record_size(self, table_name):
+        return 100
+
+
+class plannerTests(unittest.TestCase):
+    config = {"entities": ["Account"], "includeAttachments": True, "customBatchSizes": {}, "attachments": None,
+              "queryFilter": "CreatedDate = LAST_YEAR", "recordLimit": 5000,
+              "measuredThroughput": {"bulkRecordsPerSecond": 1000, "restCallsPerSecond": 10, "bytesPerSecond": 1000}}
+
+    def test_records_are_counted_like_they_are_downloaded(self):
+        source = FakeSource(100000)
+        plan = planner.build_plan(self.config, source, FakeStagingDb(), {}, 10000)
+        self.assertEqual({"Account": "CreatedDate = LAST_YEAR",
+                          "ContentVersion": " isLatest = true  AND FileExtension != 'snote' AND CreatedDate = LAST_YEAR",
+                          "Attachment": "CreatedDate = LAST_YEAR"}, source.where_clauses)
+        self.assertEqual([5000] * 4, [phase["records"] for phase in plan])
+
+
 if __name__ == '__main__':
     unittest.main()
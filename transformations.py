@@ -12,7 +12,7 @@ def transform_data(records, sfdc_object, namespaces, sfdc):
 
 def convert_managed_to_unmanaged_field_names(records, sfdc_object, sfdc, namespaces):
     new_records = []
-    describe = sfdc.conn.__getattr__(sfdc_object).describe()
+    describe = sfdc.describe(sfdc_object)
     createable_fields = {}
     for field in describe['fields']:
         if field['createable']:
@@ -39,10 +39,7 @@ def convert_managed_to_unmanaged_field_names(records, sfdc_object, sfdc, namespa
         for field in record.keys():
             if field not in createable_fields.keys():
                 continue
-            new_field_name = field
-            for namespace in namespaces:
-                if namespace in field:
-                    new_field_name = field.replace(namespace, "")
+            new_field_name = strip_namespaces(field, namespaces)
             new_record[new_field_name] = convert_field_type(record[field], createable_fields[field]['type'])
 
             if createable_fields[field]['type'] == 'reference' and is_managed_object(createable_fields[field]['referenceTo'], namespaces):
@@ -96,6 +93,19 @@ def convert_managed_to_unmanaged_field_names(records, sfdc_object, sfdc, namespa
     return new_records
 
 
+def strip_namespaces(name, namespaces):
+    new_name = name
+    for namespace in namespaces:
+        if namespace in name:
+            new_name = name.replace(namespace, "")
+    return new_name
+
+
+def transform_object(sfdc_object, namespaces):
+    # managed objects are migrated into their unmanaged counterpart in the destination org
+    return strip_namespaces(sfdc_object, namespaces)
+
+
 def is_managed_object(sfdc_object, namespaces):
     if isinstance(sfdc_object, list):
         sfdc_object = sfdc_object[0]